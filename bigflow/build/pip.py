@@ -1,22 +1,50 @@
 """Compiles, reads, validates `requirements.txt` files.
 """
 
+import os
 import re
+import sys
 import typing
 import logging
 import tempfile
 import textwrap
+import contextlib
 import hashlib
+import functools
 import subprocess
 
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 import bigflow.commons as bf_commons
 
 
 logger = logging.getLogger(__name__)
 
+# `-r file.in` directive, captures the file name (skipping trailing comment)
+_INCLUDE_RE = re.compile(rb"(?m)^[ \t]*-r[ \t]+([^#\r\n]+)")
+
+# non-empty and non-comment line, captures the content before `#`
+_REQUIREMENT_LINE_RE = re.compile(r"(?m)^[^\S\n]*([^#\s][^#\r\n]*)")
+
+# (path, mtime_ns, size) - identifies a particular version of a file
+_FileKey = Tuple[str, int, int]
+
+# `# $source-hash: algorithm:hexdigest` marker, written into compiled `requirements.txt`
+_SOURCE_HASH_RE = re.compile(r"(?m)^#\s*\$source-hash:\s*((\w+):\w+)")
+
+# Hash is only used to detect changes of `requirements.in` - no need for cryptographic strength.
+# The first one is used for new files, others are still accepted (files generated by older versions).
+_SOURCE_HASH_ALGORITHMS: Dict[str, typing.Callable[[], typing.Any]] = {
+    'blake2b': lambda: hashlib.blake2b(digest_size=16),
+    'sha256': hashlib.sha256,
+}
+_DEFAULT_SOURCE_HASH_ALGORITHM = next(iter(_SOURCE_HASH_ALGORITHMS))
+
+# (requirements.in path, algorithm) -> (keys of all scanned files, hash)
+_REQUIREMENTS_IN_HASH_CACHE_SIZE = 64
+_requirements_in_hash_cache: Dict[Tuple[str, str], Tuple[List[_FileKey], str]] = {}
+
 
 def pip_compile(
     requiremenets: Path,
@@ -34,6 +62,7 @@ def pip_compile(
     requirements_txt = requiremenets.with_suffix(".txt")
     requirements_in = requiremenets.with_suffix(".in")
     logger.info("Compile requirements file %s ...", requirements_in)
+    clear_caches()
 
     with tempfile.NamedTemporaryFile('w+t', prefix=f"{requirements_in.stem}-", suffix=".txt", delete=False) as txt_file:
         txt_path = Path(txt_file.name)
@@ -41,8 +70,7 @@ def pip_compile(
         if requirements_txt.exists() and not rebuild:
             txt_path.write_bytes(requirements_txt.read_bytes())
 
-        bf_commons.run_process([
-            "pip-compile",
+        args = [
             "--no-header",
             *(["-o", txt_path] if not dry_run else []),
             *(["--dry-run"] if dry_run else []),
@@ -53,7 +81,9 @@ def pip_compile(
             *(["-v"] if verbose else ["-q"]),
             *extra_args,
             str(requirements_in),
-        ], check=True)
+        ]
+        # dry runs are executed many times in a row (see `generate_pinfile`) - avoid interpreter startup
+        _run_pip_compile(args, in_process=dry_run)
 
         reqs_content = txt_path.read_text()
 
@@ -74,6 +104,65 @@ def pip_compile(
         out.write(reqs_content)
 
 
+@contextlib.contextmanager
+def _preserve_logging_config():
+    """Restores root logger configuration, 'pip' reconfigures logging via `logging.config.dictConfig`."""
+    root = logging.getLogger()
+    handlers, level, disable = root.handlers[:], root.level, logging.root.manager.disable
+    disabled = {
+        name: lg.disabled
+        for name, lg in logging.root.manager.loggerDict.items()
+        if isinstance(lg, logging.Logger)
+    }
+    try:
+        yield
+    finally:
+        root.handlers[:] = handlers
+        root.setLevel(level)
+        logging.disable(disable)
+        for name, d in disabled.items():
+            logging.getLogger(name).disabled = d
+
+
+def _run_pip_compile(args, in_process=False):
+    """Runs 'pip-compile', raises `subprocess.CalledProcessError` on failure.
+
+    Uses 'pip-tools' importable from the current interpreter, so dry runs and real compilations resolve pins the same way.
+    With `in_process=True` the command is executed without spawning a new interpreter.
+    """
+
+    cmd = ["pip-compile", *map(str, args)]
+    try:
+        import click
+        from piptools.scripts.compile import cli
+    except ImportError:
+        logger.debug("Module 'piptools' is not available - run 'pip-compile' as subprocess")
+        bf_commons.run_process(cmd, check=True)
+        return
+
+    if not in_process:
+        bf_commons.run_process([sys.executable, "-m", "piptools", "compile", *cmd[1:]], check=True)
+        return
+
+    logger.debug("run pip-compile in-process %r", cmd)
+    try:
+        with _preserve_logging_config():
+            returncode = cli.main(args=cmd[1:], prog_name=cmd[0], standalone_mode=False)
+    except SystemExit as e:
+        returncode = e.code
+    except click.ClickException as e:
+        logger.error("pip-compile failed: %s", e.format_message(), exc_info=True)
+        raise subprocess.CalledProcessError(e.exit_code, cmd) from e
+    except click.Abort as e:
+        if isinstance(e.__context__, KeyboardInterrupt):
+            raise e.__context__
+        raise subprocess.CalledProcessError(1, cmd) from e
+
+    if returncode:
+        logger.error("pip-compile failed with exit code %r", returncode)
+        raise subprocess.CalledProcessError(returncode if isinstance(returncode, int) else 1, cmd)
+
+
 def detect_piptools_source_files(requirements_dir: Path) -> typing.List[Path]:
     in_files = list(requirements_dir.glob("*.in"))
 
@@ -100,23 +189,77 @@ def maybe_recompile_requirements_file(requirements_txt: Path) -> bool:
         return False
 
 
-def _collect_all_input_files_content(requirements_in: Path):
-    logger.debug("Scan all requiremenets.in-like files: %s", requirements_in)
-    c = requirements_in.read_text()
-    yield c
-    for include in re.findall(r"\s*-r\s+(.*)", c):
-        include: str
-        fn = include.split("#", 1)[0].strip()
-        yield from _collect_all_input_files_content(requirements_in.parent / fn)
+def _file_key(path: typing.Union[str, Path], st: os.stat_result = None) -> _FileKey:
+    st = st or os.stat(path)
+    return str(path), st.st_mtime_ns, st.st_size
 
 
-def compute_requirements_in_hash(requirements_in: Path):
+def clear_caches():
+    """Forgets all cached hashes & freshness checks of requirements files."""
+    _requirements_in_hash_cache.clear()
+    _read_source_hash.cache_clear()
+
+
+def _fast_read_bytes(path: Path) -> Tuple[bytes, os.stat_result]:
+    """Reads whole (small) file with a single sized `read` syscall. Returns content and file stats."""
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_CLOEXEC", 0))
+    try:
+        st = os.fstat(fd)
+        buf = os.read(fd, st.st_size)
+        while len(buf) < st.st_size:  # short read - should not happen for regular files
+            more = os.read(fd, st.st_size - len(buf))
+            if not more:
+                break
+            buf += more
+        return buf, st
+    finally:
+        os.close(fd)
+
+
+@functools.lru_cache(maxsize=64)
+def _read_source_hash(key: _FileKey) -> typing.Optional[Tuple[str, str]]:
+    """Returns `(algorithm, source_hash)` from `$source-hash` marker of compiled requirements file."""
+    buf, _ = _fast_read_bytes(Path(key[0]))
+    m = _SOURCE_HASH_RE.search(buf.decode())
+    return (m.group(2), m.group(1)) if m else None
+
+
+def _iter_input_chunks(requirements_in: Path, scanned_files: List[_FileKey]):
+    logger.debug("Scan all requiremenets.in-like files: %s", requirements_in)
+    buf, st = _fast_read_bytes(requirements_in)
+    scanned_files.append(_file_key(requirements_in, st))
+    if b"\r" in buf:
+        # universal newlines, same as `read_text()` - keeps hashes stable for files edited on Windows
+        buf = buf.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    yield buf
+
+    for m in _INCLUDE_RE.finditer(buf):
+        yield from _iter_input_chunks(requirements_in.parent / m.group(1).strip().decode(), scanned_files)
+
+
+def compute_requirements_in_hash(requirements_in: Path, algorithm=_DEFAULT_SOURCE_HASH_ALGORITHM):
+    cache_key = str(requirements_in), algorithm
+    cached = _requirements_in_hash_cache.get(cache_key)
+    if cached:
+        scanned_files, source_hash = cached
+        try:
+            if all(_file_key(k[0]) == k for k in scanned_files):
+                logger.debug("Reuse cached hash of %s", requirements_in)
+                return source_hash
+        except FileNotFoundError:
+            pass
+
     logger.debug("Calculate hash of %s", requirements_in)
-    algorithm = 'sha256'
-    h = hashlib.new(algorithm)
-    for c in _collect_all_input_files_content(requirements_in):
-        h.update(c.encode())
-    return algorithm + ":" + h.hexdigest()
+    h = _SOURCE_HASH_ALGORITHMS[algorithm]()
+    scanned_files = []
+    for chunk in _iter_input_chunks(requirements_in, scanned_files):
+        h.update(chunk)
+    source_hash = algorithm + ":" + h.hexdigest()
+
+    if len(_requirements_in_hash_cache) >= _REQUIREMENTS_IN_HASH_CACHE_SIZE:
+        _requirements_in_hash_cache.clear()
+    _requirements_in_hash_cache[cache_key] = (scanned_files, source_hash)
+    return source_hash
 
 
 def check_requirements_needs_recompile(requiremenets: Path) -> bool:
@@ -134,9 +277,15 @@ def check_requirements_needs_recompile(requiremenets: Path) -> bool:
         logger.debug("File %s does not exist - need to be compiled by 'pip-compile'", requirements_txt)
         return True
 
-    requirements_txt_content = requirements_txt.read_text()
-    hash1 = compute_requirements_in_hash(requirements_in)
-    same_hash = hash1 in requirements_txt_content
+    # Repeated checks of unchanged files only `stat` them, see `compute_requirements_in_hash`.
+    # Modification times alone can't prove freshness (e.g. `.txt` written by git after `.in`).
+    marker = _read_source_hash(_file_key(requirements_txt))
+    if marker and marker[0] in _SOURCE_HASH_ALGORITHMS:
+        algorithm, txt_hash = marker
+        same_hash = txt_hash == compute_requirements_in_hash(requirements_in, algorithm)
+    else:
+        logger.debug("File %s has no known $source-hash marker", requirements_txt)
+        same_hash = False
 
     if same_hash:  # dirty but works ;)
         logger.debug("Don't need to compile %s file", requirements_txt)
@@ -156,17 +305,18 @@ def read_requirements(requirements_path: Path, recompile_check=True) -> List[str
         raise ValueError("Requirements needs to be recompiled with 'pip-tools'")
 
     result: List[str] = []
-    with open(requirements_path) as base_requirements:
-        for line in base_requirements:
-            line = line.split("#", 1)[0].strip()
-            if line.startswith("-r "):
-                subrequirements_file_name = line.replace("-r ", "")
-                subrequirements_path = requirements_path.parent / subrequirements_file_name
-                result.extend(read_requirements(subrequirements_path, recompile_check=False))
-            elif line.startswith("--"):
-                logger.debug("skip requirements line %r", line)
-            elif line:
-                result.append(line)
+    buf, _ = _fast_read_bytes(requirements_path)
+    # lone '\r' is a line break too (universal newlines), extra empty lines are skipped anyway
+    for m in _REQUIREMENT_LINE_RE.finditer(buf.decode().replace("\r", "\n")):
+        line = m.group(1).rstrip()
+        if line.startswith("-r "):
+            subrequirements_file_name = line.replace("-r ", "")
+            subrequirements_path = requirements_path.parent / subrequirements_file_name
+            result.extend(read_requirements(subrequirements_path, recompile_check=False))
+        elif line.startswith("--"):
+            logger.debug("skip requirements line %r", line)
+        else:
+            result.append(line)
 
     return result
 
@@ -215,32 +365,50 @@ def generate_pinfile(
 
 def _try_incrementally_add_pins(pins_file_in, requirements_in, pins):
     bad_pins = []
-    all_pins = []
-
-    for i, pin in enumerate(pins):
-        logger.info("\n(%d/%d) Trying to pin %r ...", i + 1, len(pins), pin)
-        logger.info("Temporarily add %r to %s", pin, pins_file_in)
-        pins_file_in.write_text("\n".join([
-            "# *** autogenerated - partial! ***",
-            *all_pins,
-            pin,
-            "# ...",
-        ]))
-        try:
-            pip_compile(requirements_in, dry_run=True)
-        except subprocess.CalledProcessError:
-            logger.error("FAIL, revert")
-            all_pins.append(f"## {pin}  # CONFLICT")
-            bad_pins.append(pin)
+    good_pins = []
+
+    # Try to add all pins at once, bisect the batch only when `pip-compile` fails.
+    # Most pins don't conflict, so this needs much less `pip-compile` runs than checking pins one by one.
+    def probe(batch, known_to_fail=False):
+        if not known_to_fail:
+            logger.info("\nTrying to pin %d libraries: %s ...", len(batch), ", ".join(batch))
+            logger.info("Temporarily add %d pins to %s", len(batch), pins_file_in)
+            pins_file_in.write_text("\n".join([
+                "# *** autogenerated - partial! ***",
+                *good_pins,
+                *batch,
+                "# ...",
+            ]))
+            try:
+                pip_compile(requirements_in, dry_run=True)
+            except subprocess.CalledProcessError:
+                pass
+            else:
+                logger.info("OK, keep it")
+                good_pins.extend(batch)
+                return
+
+        if len(batch) == 1:
+            logger.error("FAIL, revert %r", batch[0])
+            bad_pins.append(batch[0])
         else:
-            logger.info("OK, keep it")
-            all_pins.append(pin)
-
+            logger.info("FAIL, split the batch")
+            mid = len(batch) // 2
+            good_before = len(good_pins)
+            probe(batch[:mid])
+            # when the whole left half was accepted, `good_pins + right half` is exactly what has just failed
+            probe(batch[mid:], known_to_fail=len(good_pins) - good_before == mid)
+
+    pins = list(dict.fromkeys(pins))  # drop duplicates, keep the order
+    if pins:
+        probe(pins)
+
+    all_pins = [f"## {pin}  # CONFLICT" if pin in bad_pins else pin for pin in pins]
     return bad_pins, all_pins
 
 
 def _include_pinsfile_into_requirements(pins_file_in, requirements_in):
-    req = requirements_in.read_text()
+    req = _fast_read_bytes(requirements_in)[0].decode()
     m = re.search(rf"\s+-r\s+{re.escape(pins_file_in.name)}\s*#.*$", req)
     if m:
         logger.info("Pins file %s is already included into %s", pins_file_in, requirements_in)
@@ -864,6 +864,7 @@ def _is_log_module_installed():
 
 
 def cli(raw_args) -> None:
+    bigflow.build.pip.clear_caches()
     bigflow.build.dev.install_syspath()
     bigflow.migrate.check_migrate()
 
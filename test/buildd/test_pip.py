@@ -1,5 +1,13 @@
+import os
+import sys
+import types
 import logging
+import logging.config
+import subprocess
 import unittest
+import unittest.mock
+
+import click
 
 from pathlib import Path
 
@@ -11,9 +19,14 @@ import bigflow.build.pip as bf_pip
 class PipToolsTestCase(
     mixins.TempCwdMixin,
     mixins.FileUtilsMixin,
-    unittest.TestCase,
+    mixins.BaseTestCase,
 ):
 
+    def setUp(self):
+        super().setUp()
+        bf_pip.clear_caches()
+        self.addCleanup(bf_pip.clear_caches)
+
     def test_should_compile_requirements(self):
         # given
         req_in = self.cwd / "req.in"
@@ -86,6 +99,117 @@ class PipToolsTestCase(
         with self.assertLogs(bf_pip.logger, level=logging.WARNING):
             self.assertTrue(bf_pip.check_requirements_needs_recompile(req_in))
 
+    def test_accept_legacy_sha256_source_hash(self):
+
+        # given
+        req_in = self.cwd / "req.in"
+        req_txt = self.cwd / "req.txt"
+        req_in.write_bytes(b"pandas>=1.1")
+        # written by bigflow 1.7.0
+        req_txt.write_text(
+            "# $source-hash: sha256:c1a942bdf489d42bbed50c355c75de9bfd771829daf446f059e3c8520c02396a\n"
+            "pandas==1.1.5")
+
+        # then
+        self.assertTrue(bf_pip.compute_requirements_in_hash(req_in).startswith("blake2b:"))
+        self.assertFalse(bf_pip.check_requirements_needs_recompile(req_in))
+
+    def test_hash_sources_only_with_algorithm_from_marker(self):
+
+        # given
+        req_in = self.cwd / "req.in"
+        req_txt = self.cwd / "req.txt"
+        req_in.write_bytes(b"pandas>=1.1")
+        req_txt.write_text(
+            "# $source-hash: sha256:c1a942bdf489d42bbed50c355c75de9bfd771829daf446f059e3c8520c02396a\n"
+            "pandas==1.1.5")
+
+        # when
+        with unittest.mock.patch.object(
+            bf_pip, 'compute_requirements_in_hash', wraps=bf_pip.compute_requirements_in_hash,
+        ) as compute_requirements_in_hash:
+            needs_recompile = bf_pip.check_requirements_needs_recompile(req_in)
+
+        # then
+        self.assertFalse(needs_recompile)
+        compute_requirements_in_hash.assert_called_once_with(req_in, 'sha256')
+
+    def test_accept_legacy_sha256_source_hash_crlf(self):
+
+        # given
+        req_in = self.cwd / "req.in"
+        sub_in = self.cwd / "sub.in"
+        req_txt = self.cwd / "req.txt"
+        req_in.write_bytes(b"-r sub.in\r\npandas>=1.1\r\n")
+        sub_in.write_bytes(b"numpy\r\n")
+        # written by bigflow 1.7.0
+        req_txt.write_text(
+            "# $source-hash: sha256:1e9dcb5c56d5e7d20bfd0c1423912ed20bef52a9c0c061a5272ec3381535c1e1\n"
+            "numpy==1.19.5\npandas==1.1.5")
+
+        # then
+        self.assertFalse(bf_pip.check_requirements_needs_recompile(req_in))
+
+    def test_detect_stale_requirements_txt_newer_than_source(self):
+
+        # given
+        req_in = self.cwd / "req.in"
+        req_txt = self.cwd / "req.txt"
+        req_in.write_text("pandas>=1.1")
+        req_txt.write_text("# $source-hash: blake2b:00000000000000000000000000000000\npandas==1.1.5")
+        os.utime(req_in, ns=(0, req_txt.stat().st_mtime_ns - 10**9))
+
+        # then
+        with self.assertLogs(bf_pip.logger, level=logging.WARNING):
+            self.assertTrue(bf_pip.check_requirements_needs_recompile(req_in))
+
+        # when
+        req_txt.write_text("pandas==1.1.5")
+
+        # then
+        with self.assertLogs(bf_pip.logger, level=logging.WARNING):
+            self.assertTrue(bf_pip.check_requirements_needs_recompile(req_in))
+
+    def test_repeated_freshness_check_does_not_read_files(self):
+
+        # given
+        req_in = self.cwd / "req.in"
+        req_txt = self.cwd / "req.txt"
+        req_in.write_text("pandas>=1.1")
+        req_txt.write_text(f"# $source-hash: {bf_pip.compute_requirements_in_hash(req_in)}\npandas==1.1.5")
+        self.assertFalse(bf_pip.check_requirements_needs_recompile(req_in))
+
+        # when
+        with unittest.mock.patch.object(bf_pip, '_fast_read_bytes') as fast_read_bytes:
+            needs_recompile = bf_pip.check_requirements_needs_recompile(req_in)
+
+        # then
+        self.assertFalse(needs_recompile)
+        fast_read_bytes.assert_not_called()
+
+    def test_reuse_hash_of_unchanged_requirements(self):
+
+        # given
+        req_in = self.cwd / "req.in"
+        sub_in = self.cwd / "sub.in"
+        req_in.write_text("-r sub.in")
+        sub_in.write_text("pandas>=1.1")
+        hash1 = bf_pip.compute_requirements_in_hash(req_in)
+
+        # when
+        with unittest.mock.patch.object(bf_pip, '_iter_input_chunks') as iter_input_chunks:
+            hash2 = bf_pip.compute_requirements_in_hash(req_in)
+
+        # then
+        self.assertEqual(hash1, hash2)
+        iter_input_chunks.assert_not_called()
+
+        # when
+        sub_in.write_text("pandas>=1.1.1,<2")
+
+        # then
+        self.assertNotEqual(hash1, bf_pip.compute_requirements_in_hash(req_in))
+
     def test_automatically_recompile_requirements(self):
         # given
         req_in = self.cwd / "req.in"
@@ -122,6 +246,16 @@ class PipToolsTestCase(
             'datetime_truncate==1.1.0',
         ])
 
+    def test_read_requirements_with_any_leading_whitespace(self):
+        # given
+        (self.cwd / "requirements.txt").write_bytes(b"\fpandas\n\t\vnumpy  # comment\r\n \f\rsix\n")
+
+        # when
+        requirements = bf_pip.read_requirements(self.cwd / "requirements.txt", recompile_check=False)
+
+        # then
+        self.assertEqual(requirements, ['pandas', 'numpy', 'six'])
+
     def test_generate_pinfile(self):
 
         # given
@@ -151,4 +285,162 @@ class PipToolsTestCase(
         self.assertFileContentRegex(req_txt, r"(?m)^requests==2.25.1$")
         self.assertFileContentRegex(req_txt, r"(?m)^idna==2.10$")
         self.assertFileContentRegex(req_txt, r"(?m)^urllib3==1.26.2$")
-        self.assertFileContentRegex(req_txt, r"(?m)^chardet==4.0.0$")
\ No newline at end of file
+        self.assertFileContentRegex(req_txt, r"(?m)^chardet==4.0.0$")
+
+    def _mock_pip_compile_dry_run(self, pins_in, conflicting):
+        probes = []
+
+        def pip_compile(requirements, dry_run):
+            self.assertTrue(dry_run)
+            pins = [line for line in pins_in.read_text().splitlines() if not line.startswith("#")]
+            probes.append(pins)
+            if conflicting(pins):
+                raise subprocess.CalledProcessError(1, "pip-compile")
+
+        self.addMock(unittest.mock.patch.object(bf_pip, 'pip_compile', side_effect=pip_compile))
+        return probes
+
+    def test_add_all_pins_with_single_probe(self):
+        # given
+        pin_in = self.cwd / "pin.in"
+        probes = self._mock_pip_compile_dry_run(pin_in, lambda pins: False)
+
+        # when
+        bad_pins, all_pins = bf_pip._try_incrementally_add_pins(pin_in, self.cwd / "req.in", ["a", "b", "c", "a"])
+
+        # then
+        self.assertEqual(bad_pins, [])
+        self.assertEqual(all_pins, ["a", "b", "c"])
+        self.assertEqual(probes, [["a", "b", "c"]])
+
+    def test_bisect_conflicting_pins(self):
+        # given
+        pin_in = self.cwd / "pin.in"
+        probes = self._mock_pip_compile_dry_run(
+            pin_in,
+            lambda pins: "b" in pins or {"c", "f"} <= set(pins),
+        )
+
+        # when
+        bad_pins, all_pins = bf_pip._try_incrementally_add_pins(
+            pin_in, self.cwd / "req.in", ["a", "b", "c", "d", "b", "e", "f", "g", "h"])
+
+        # then
+        self.assertEqual(bad_pins, ["b", "f"])
+        self.assertEqual(all_pins, [
+            "a", "## b  # CONFLICT", "c", "d", "e", "## f  # CONFLICT", "g", "h",
+        ])
+        self.assertEqual(probes, [
+            ["a", "b", "c", "d", "e", "f", "g", "h"],
+            ["a", "b", "c", "d"],
+            ["a", "b"],
+            ["a"],
+            ["a", "c", "d"],
+            ["a", "c", "d", "e", "f", "g", "h"],
+            ["a", "c", "d", "e", "f"],
+            ["a", "c", "d", "e"],
+            ["a", "c", "d", "e", "g", "h"],
+        ])
+
+    def _mock_piptools_cli(self, **kwargs):
+        cli = unittest.mock.Mock(**kwargs)
+        compile_module = types.ModuleType("piptools.scripts.compile")
+        compile_module.cli = cli
+        self.addMock(unittest.mock.patch.dict(sys.modules, {
+            "piptools": types.ModuleType("piptools"),
+            "piptools.scripts": types.ModuleType("piptools.scripts"),
+            "piptools.scripts.compile": compile_module,
+        }))
+        return cli
+
+    def test_run_pip_compile_in_process(self):
+        # given
+        cli = self._mock_piptools_cli(**{'main.return_value': None})
+
+        # when
+        bf_pip._run_pip_compile(["--dry-run", Path("req.in")], in_process=True)
+
+        # then
+        cli.main.assert_called_once_with(
+            args=["--dry-run", "req.in"], prog_name="pip-compile", standalone_mode=False)
+
+    def test_map_pip_compile_exit_code_to_called_process_error(self):
+        # given
+        self._mock_piptools_cli(**{'main.side_effect': SystemExit(2)})
+
+        # then
+        with self.assertLogs(bf_pip.logger, level=logging.ERROR):
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                bf_pip._run_pip_compile(["req.in"], in_process=True)
+        self.assertEqual(cm.exception.returncode, 2)
+        self.assertEqual(cm.exception.cmd, ["pip-compile", "req.in"])
+
+    def test_map_pip_compile_click_error_to_called_process_error(self):
+        # given
+        self._mock_piptools_cli(**{'main.side_effect': click.UsageError("no such option")})
+
+        # then
+        with self.assertLogs(bf_pip.logger, level=logging.ERROR) as logs:
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                bf_pip._run_pip_compile(["req.in"], in_process=True)
+        self.assertEqual(cm.exception.returncode, 2)
+        self.assertIn("no such option", logs.output[0])
+
+    def test_propagate_unexpected_pip_compile_errors(self):
+        # given
+        self._mock_piptools_cli(**{'main.side_effect': RuntimeError("bug")})
+
+        # then
+        with self.assertRaises(RuntimeError):
+            bf_pip._run_pip_compile(["req.in"], in_process=True)
+
+    def test_propagate_keyboard_interrupt_from_pip_compile(self):
+        # given
+        def main(**kwargs):
+            try:
+                raise KeyboardInterrupt()
+            except KeyboardInterrupt:
+                raise click.Abort()  # the same as `click` does when not in standalone mode
+
+        self._mock_piptools_cli(**{'main.side_effect': main})
+
+        # then
+        with self.assertRaises(KeyboardInterrupt):
+            bf_pip._run_pip_compile(["req.in"], in_process=True)
+
+    def test_preserve_root_logging_after_pip_compile_in_process(self):
+        # given
+        root = logging.getLogger()
+        handler = logging.StreamHandler()
+        self.addMock(unittest.mock.patch.object(root, 'handlers', [handler]))
+        self.addMock(unittest.mock.patch.object(root, 'level', logging.INFO))
+
+        def main(**kwargs):
+            # 'pip' configures logging in a similar way
+            logging.config.dictConfig({
+                "version": 1,
+                "disable_existing_loggers": False,
+                "handlers": {"console": {"class": "logging.StreamHandler"}},
+                "root": {"level": "ERROR", "handlers": ["console"]},
+            })
+
+        self._mock_piptools_cli(**{'main.side_effect': main})
+
+        # when
+        bf_pip._run_pip_compile(["req.in"], in_process=True)
+
+        # then
+        self.assertEqual(root.handlers, [handler])
+        self.assertEqual(root.level, logging.INFO)
+
+    def test_run_pip_compile_as_subprocess_of_same_interpreter(self):
+        # given
+        self._mock_piptools_cli()
+        run_process = self.addMock(unittest.mock.patch.object(bf_pip.bf_commons, 'run_process'))
+
+        # when
+        bf_pip._run_pip_compile(["-o", Path("req.txt"), "req.in"])
+
+        # then
+        run_process.assert_called_once_with(
+            [sys.executable, "-m", "piptools", "compile", "-o", "req.txt", "req.in"], check=True)